@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 
-import json
+import itertools
 import os
 import sys
 
+import ijson
+import matplotlib
+
+matplotlib.use("Agg")
+
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
+import numba
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -13,6 +19,19 @@ from flexitext import flexitext
 from matplotlib import lines
 from matplotlib.patheffects import withStroke
 
+try:
+    import orjson
+
+    def load_json(path):
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+except ImportError:
+    import ujson
+
+    def load_json(path):
+        with open(path) as f:
+            return ujson.load(f)
+
 if len(sys.argv) != 4:
     print("Invalid arguments, usage:")
     print("{} [data-dir] [output-figure-dir]".format(sys.argv[0]))
@@ -21,17 +40,48 @@ if len(sys.argv) != 4:
 data_dir = sys.argv[1]
 output_figure_dir = sys.argv[2]
 
-events_data = {}
 events_file_path = os.path.join(data_dir, "latent-watch.json")
-with open(events_file_path) as events_file:
-    events_data = json.load(events_file)
-
-cadvisor_data = {}
 cadvisor_file_path = os.path.join(data_dir, "data.json")
-with open(cadvisor_file_path) as cadvisor_file:
-    cadvisor_data = json.load(cadvisor_file)
 
-def annotate_axis(ax, xticks, xticklabels, max_y, max_x, ytickformat, title):
+
+def stream_cadvisor_data(path):
+    # yields (id, records) pairs one component at a time, so we never hold the whole file in memory
+    with open(path, "rb") as f:
+        yield from ijson.kvitems(f, "", use_float=True)
+
+
+# bump whenever parsing changes, so sidecars written by an older parser are not reused
+cache_version = 2
+
+
+def load_cached(path, parse):
+    # the data directory is immutable per experiment, so keep the parsed frame next to the
+    # input and only re-parse when the input is newer than the cache
+    cache_path = os.path.join(
+        os.path.dirname(path),
+        ".{}.cache.v{}.feather".format(os.path.splitext(os.path.basename(path))[0], cache_version)
+    )
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            return pd.read_feather(cache_path)
+        except (OSError, ImportError, ValueError) as e:
+            print("Ignoring unreadable cache {}: {}".format(cache_path, e))
+    df = parse(path)
+    # write to a temporary file and move it into place, so an interrupted run never leaves a partial sidecar
+    partial_path = "{}.{}.partial".format(cache_path, os.getpid())
+    try:
+        df.to_feather(partial_path)
+        os.replace(partial_path, cache_path)
+    except (OSError, ImportError, ValueError) as e:
+        # a read-only data directory, missing pyarrow or a frame feather can't store only costs us the cache
+        print("Not caching {}: {}".format(path, e))
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    return df
+
+
+def annotate_axis(ax, xticks, xticklabels, max_x, ytickformat, title):
     ax.set_ylabel('')
     ax.set_xlabel('')
     ax.xaxis.set_ticks(xticks)
@@ -42,22 +92,17 @@ def annotate_axis(ax, xticks, xticklabels, max_y, max_x, ytickformat, title):
     ax.yaxis.set_major_locator(plt.MaxNLocator(6, steps=[1, 2, 4, 5, 10]))
     ax.yaxis.set_label_position("right")
     ax.yaxis.tick_right()
-    ax.yaxis.set_tick_params(labelleft=False, length=0)
-    formatter = ticker.FuncFormatter(lambda y, pos: '')
-    ax.yaxis.set_major_formatter(formatter)
+    ax.yaxis.set_tick_params(labelleft=False, labelright=True, length=0, pad=0, labelsize=18)
     ax.set_xlim(left=-1, right=max_x)
-    PAD = max_y * 0.01
-    for label in ax.get_yticks()[1:-1]:
-        ax.text(
-            max_x, label + PAD, ytickformat(label),
-            ha="right", va="baseline", fontsize=18, fontweight=100
-        )
-    plt.legend(loc="lower right", fontsize=12, frameon=False)
+    # label every interior gridline in place with the tick machinery rather than one Text artist each
+    labelled = ax.get_yticks()[1:-1]
+    formatter = ticker.FuncFormatter(lambda y, pos: ytickformat(y) if np.isclose(labelled, y).any() else '')
+    ax.yaxis.set_major_formatter(formatter)
+    plt.setp(ax.get_yticklabels(), ha="right", va="bottom", fontweight=100)
 
     ax.spines["right"].set_visible(False)
     ax.spines["top"].set_visible(False)
     ax.spines["left"].set_visible(False)
-    ax.get_legend().remove()
 
     ax.spines["bottom"].set_lw(1.2)
     ax.spines["bottom"].set_capstyle("butt")
@@ -77,7 +122,7 @@ second = 1000 * millisecond
 
 
 def format(nanoseconds):
-    nanoseconds = np.power(10, nanoseconds)
+    nanoseconds = 10 ** float(nanoseconds)
     if second <= nanoseconds:
         return '{:.0f}'.format(nanoseconds / second) + 's'
     elif millisecond <= nanoseconds < second:
@@ -102,110 +147,172 @@ def formatBytes(bytes):
         return '{:,.0f}'.format(bytes / gigabyte) + 'GB'
 
 
-def parse_cadvisor_data(data):
-    for id in data:
-        if len(data[id]) == 1:
-            # we have a non-ha setup, can simply parse
-            return parse_singleton_data(data)
-        else:
-            # we have HA data
-            return parse_ha_data(data)
+def parse_timestamps(items):
+    # strip the trailing Z and parse every timestamp in one shot instead of per-item np.datetime64 calls
+    raw = np.array([item["timestamp"] for item in items])
+    return np.char.rstrip(raw, "Z").astype("datetime64[ns]")
 
 
-def parse_singleton_data(data):
-    components = []
-    cpus = []
-    mems = []
-    timestamps = []
-    for id in data:
-        for record in data[id]:
-            base = np.datetime64(data[id][record][0]["timestamp"].removesuffix("Z"))
-            sub_cpus = []
-            sub_ts = []
-            for item in data[id][record]:
-                components.append(id)
-                mems.append(item["memory"]["working_set"])
-                sub_cpus.append(item["cpu"]["usage"]["total"] / 1e9)
-                sub_ts.append((np.datetime64(item["timestamp"].removesuffix("Z")) - base) / np.timedelta64(1, 's'))
-
-            grad = np.gradient(sub_cpus, sub_ts)
-            cpus.extend(grad)
-            timestamps.extend(sub_ts)
-
-    df = pd.DataFrame({"component": components, "cpu": cpus, "mem": mems, "timestamp": timestamps})
+def parse_cpus(items):
+    return np.fromiter(
+        (item["cpu"]["usage"]["total"] for item in items), dtype=np.float64, count=len(items)
+    ) / 1e9
+
+
+def parse_mems(items):
+    return np.fromiter((item["memory"]["working_set"] for item in items), dtype=np.int64, count=len(items))
+
+
+def build_frame(components, cpus, mems, timestamps):
+    # every column arrives as a list of per-component arrays, so join each one once
+    # and hand the result to pandas without another copy; components are stored as
+    # categorical codes rather than one string per row
+    codes = np.repeat(np.arange(len(components), dtype=np.int16), [t.size for t in timestamps])
+    df = pd.DataFrame({
+        "component": pd.Categorical.from_codes(codes, categories=components),
+        "cpu": np.concatenate(cpus),
+        "mem": np.concatenate(mems),
+        "timestamp": np.concatenate(timestamps),
+    }, copy=False)
     df.info()
     return df
 
 
-def parse_ha_data(data):
+# pandas hands out read-only views of its data, so the inputs are declared read-only
+readonly_float64_array = numba.types.Array(numba.types.float64, 1, "A", readonly=True)
+
+
+@numba.njit(
+    numba.types.float64[:](readonly_float64_array, readonly_float64_array),
+    cache=True, nogil=True, boundscheck=False
+)
+def central_difference(values, ts):
+    # np.gradient(values, ts) with its second-order weights for uneven spacing, in one pass and one allocation
+    n = values.size
+    if n < 2:
+        # bounds checks are off, so refuse short series here the way np.gradient does
+        raise ValueError("at least 2 samples are required to compute a rate")
+    rate = np.empty(n)
+    rate[0] = (values[1] - values[0]) / (ts[1] - ts[0])
+    rate[n - 1] = (values[n - 1] - values[n - 2]) / (ts[n - 1] - ts[n - 2])
+    for i in range(1, n - 1):
+        left = ts[i] - ts[i - 1]
+        right = ts[i + 1] - ts[i]
+        rate[i] = (
+            -right / (left * (left + right)) * values[i - 1]
+            + (right - left) / (left * right) * values[i]
+            + left / (right * (left + right)) * values[i + 1]
+        )
+    return rate
+
+
+@numba.njit(
+    numba.types.float64[:](readonly_float64_array, readonly_float64_array, numba.types.int64),
+    cache=True, nogil=True, boundscheck=False
+)
+def smoothed_rate(values, ts, weight):
+    # fuses central_difference(values, ts) and a boxcar average of the rate into a single compiled call
+    rate = central_difference(values, ts)
+    n = rate.size
+
+    # same window alignment as np.convolve(..., 'same'), treating samples off either end as zero
+    lead = weight - 1 - (weight - 1) // 2
+    lag = (weight - 1) // 2
+    out = np.empty(n)
+    running = 0.0
+    for i in range(min(lag, n)):
+        running += rate[i]
+    for i in range(n):
+        if i + lag < n:
+            running += rate[i + lag]
+        if i - lead - 1 >= 0:
+            running -= rate[i - lead - 1]
+        out[i] = running / weight
+    return out
+
+
+# number of resampled points averaged together when smoothing HA CPU usage
+smoothing_weight = 10
+
+
+def parse_cadvisor_data(data):
     components = []
     cpus = []
     mems = []
     timestamps = []
-    for id in data:
-        mem = None
-        cpu = None
-        for record in data[id]:
-            base = np.datetime64(data[id][record][0]["timestamp"].removesuffix("Z"))
-            sub_cpus = [item["cpu"]["usage"]["total"] / 1e9 for item in data[id][record]]
-            sub_mems = [item["memory"]["working_set"] for item in data[id][record]]
-            sub_ts = [np.datetime64(item["timestamp"].removesuffix("Z")) - base for item in data[id][record]]
-
-            mem_series = pd.Series(sub_mems, index=sub_ts)
-            resampled_mem = mem_series.resample("3S").mean().interpolate(method="time")
-            if mem is None:
-                mem = resampled_mem
-            else:
-                mem = mem.add(resampled_mem)
-
-            cpu_series = pd.Series(sub_cpus, index=sub_ts)
-            resampled_cpu = cpu_series.resample("3S").mean().interpolate(method="time")
-            if cpu is None:
-                cpu = resampled_cpu
-            else:
-                cpu = cpu.add(resampled_cpu)
-
-        timestamp_seconds = [t / np.timedelta64(1, 's') for t in cpu.index]
-        cpu_rate = np.gradient(cpu.values, timestamp_seconds)
-
-        components.extend([id for item in timestamp_seconds])
-        timestamps.extend(timestamp_seconds)
-        weight = 10
-        avg = np.convolve(cpu_rate, np.ones(weight), 'same') / weight
-        cpus.extend(avg)
-        mems.extend(mem.values)
-
-    df = pd.DataFrame({"component": components, "cpu": cpus, "mem": mems, "timestamp": timestamps})
-    df.info()
-    return df
+    for id, records in data:
+        if len(records) == 1:
+            # we have a non-ha component, differentiate the raw samples without binning or smoothing
+            items, = records.values()
+            ts = parse_timestamps(items)
+            timestamp_seconds = (ts - ts[0]) / np.timedelta64(1, 's')
+            cpus.append(central_difference(parse_cpus(items), timestamp_seconds))
+            mems.append(parse_mems(items))
+        else:
+            # we have HA data, bin every record in one pass, then sum across records wherever they all overlap
+            frames = []
+            for record, items in records.items():
+                ts = parse_timestamps(items)
+                frames.append(pd.DataFrame({
+                    "record": record,
+                    "ts": ts - ts[0],
+                    "cpu": parse_cpus(items),
+                    "mem": parse_mems(items),
+                }))
+
+            binned = pd.concat(frames).groupby(["record", pd.Grouper(key="ts", freq="3s")]).mean().unstack("record")
+            binned = binned.reindex(pd.timedelta_range(0, binned.index.max(), freq="3s"))
+            binned = binned.interpolate(method="time", limit_area="inside")
+            mem = binned["mem"].sum(axis=1, skipna=False)
+            cpu = binned["cpu"].sum(axis=1, skipna=False)
+
+            timestamp_seconds = cpu.index.total_seconds().to_numpy()
+            cpus.append(smoothed_rate(cpu.to_numpy(dtype=np.float64), timestamp_seconds, smoothing_weight))
+            mems.append(mem.to_numpy())
+
+        components.append(id)
+        timestamps.append(timestamp_seconds)
+
+    return build_frame(components, cpus, mems, timestamps)
+
+
+def downsample(df, target=500):
+    # a line can't show more than a few hundred points at this size, so stride through each component
+    stride = -(-df.groupby("component", sort=False, observed=True)["timestamp"].transform("size") // target)
+    return df[df.groupby("component", sort=False, observed=True).cumcount() % stride == 0]
+
+
+def plot_components(ax, df, y):
+    # one series per component, so plot directly instead of going through seaborn's estimator
+    groups = df.groupby("component", sort=False, observed=True)
+    for (component, group), color in zip(groups, itertools.cycle(sns.color_palette())):
+        ax.plot(group.timestamp.to_numpy(), group[y].to_numpy(), label=component, color=color, rasterized=True)
 
 
 def plot_resource_usage(ax, df):
-    sns.lineplot(x="timestamp", y="cpu", hue="component", data=df, ax=ax[0])
+    sampled = downsample(df)
+    plot_components(ax[0], sampled, "cpu")
     annotate_axis(
         ax=ax[0],
         xticks=[],
         xticklabels=[],
-        max_y=df.cpu.max(),
         max_x=df.timestamp.max() * 1.05,
         ytickformat=lambda y: "{:0.1f}".format(y),
         title="<size:18><weight:bold>CPU Usage,</> vCPUs</>"
     )
 
-    sns.lineplot(x="timestamp", y="mem", hue="component", data=df, ax=ax[1])
+    plot_components(ax[1], sampled, "mem")
     annotate_axis(
         ax=ax[1],
         xticks=[],
         xticklabels=[],
-        max_y=df.mem.max(),
         max_x=df.timestamp.max() * 1.05,
         ytickformat=lambda y: formatBytes(y),
         title="<size:18><weight:bold>Working Set,</> bytes</>"
     )
 
     path_effects = [withStroke(linewidth=10, foreground="white")]
-    timestamps = df.loc[df['component'] == "etcd"].timestamp
-    timestamp = timestamps[timestamps.size - 190]
+    timestamp = df.loc[df["component"] == "etcd", "timestamp"].to_numpy()[-190]
     ax[0].text(
         timestamp, 4.2, "kube-api", fontsize=18,
         va="top", ha="left", path_effects=path_effects, color=sns.color_palette()[1]
@@ -227,12 +334,13 @@ def plot_resource_usage(ax, df):
 fig, axes = plt.subplot_mosaic([['left', 'upper right'],
                                 ['left', 'lower right']],
                                figsize=(12, 7.2), constrained_layout=True)
-plot_request_times(axes["left"], parse_request_times(events_data))
-plot_resource_usage([axes["upper right"], axes["lower right"]], parse_cadvisor_data(cadvisor_data))
-fig.subplots_adjust(
-    left=0, right=1,
-    top=0.825, bottom=0.15,
-    hspace=0.25, wspace=0.05
+plot_request_times(
+    axes["left"],
+    load_cached(events_file_path, lambda path: parse_request_times(load_json(path)))
+)
+plot_resource_usage(
+    [axes["upper right"], axes["lower right"]],
+    load_cached(cadvisor_file_path, lambda path: parse_cadvisor_data(stream_cadvisor_data(path)))
 )
 fig.set_facecolor("w")
 title = "<size:22><weight:bold>Server Performance as a Function of Open Watch Count\n</></>" + \
@@ -249,8 +357,9 @@ flexitext(0, .98, title, va="top", xycoords='figure fraction', ax=fig.axes[0])
 #     config_data["crcomponent"]["interact"]["parallelism"]
 # )
 fig.text(0.01, 0.02, "source", color="#a2a2a2", fontsize=12)
+# solve the layout once and freeze it, rather than re-solving on every draw
+fig.get_layout_engine().execute(fig)
+fig.set_layout_engine("none")
 fig.savefig(
     os.path.join(output_figure_dir, "indexed_requests.png"),
     dpi=300)
-plt.show()
-plt.show()